@@ -15,25 +15,103 @@ Usage:          see python3 netrun.py --help
 
 import os
 import sys
+import json
+import base64
 import argparse
-import getpass
 import logging
-from datetime import datetime
+import threading
+import time
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
 
-from scrapli import Scrapli
-
-
-# Used to split username/password lists
-DELIMITER = ","
 
 # Define the width of separator lines in headers
 SEPARATOR_WIDTH = 120
+STAR_SEPARATOR = "*" * SEPARATOR_WIDTH
+DASH_SEPARATOR = "-" * SEPARATOR_WIDTH
+
+# Buffer size of the output files, large enough to write most command outputs in a single call
+OUTPUT_BUFFER_SIZE = 1 << 20
+
+# Characters of a command replaced by dashes when used in a filename (whitespaces, and the
+# characters that are not allowed in filenames on Windows or POSIX systems)
+FILENAME_TRANSLATION = str.maketrans(' /\\|<>:*?"', "-" * 10)
+
+# Format of the timestamps used in output headers and filenames
+TIMESTAMP_FORMAT = "%Y-%m-%d_%Hh%Mm%S"
+
+# Default number of hosts handled in parallel (kept below the default sshd MaxStartups of 10 for jump hosts)
+DEFAULT_WORKERS = 8
+
+# Connection retries on transient errors, with an exponential backoff capped to RETRY_MAX_DELAY seconds
+DEFAULT_RETRIES = 2
+RETRY_MAX_DELAY = 30
+
+# Addresses resolved with --resolve, cached as {(host, family): (address, expiry)}
+DNS_CACHE = {}
+DNS_CACHE_TTL = 300
+
+# Number of parallel DNS lookups when resolving the whole inventory up front
+DNS_WORKERS = 32
+
+# Used to serialize writes to the terminal between worker threads
+PRINT_LOCK = threading.Lock()
+
+# Extra options passed to the SSH client by the system transport: legacy key exchange and
+# ciphers for older devices, and no GSSAPI probing or host IP checks, which only add
+# round-trips at connect time
+SSH_OPEN_CMD = (
+    "-o", 
+    "KexAlgorithms=+diffie-hellman-group1-sha1,diffie-hellman-group-exchange-sha1,diffie-hellman-group14-sha1",
+    "-o",
+    "Ciphers=+aes128-ctr,aes192-ctr,aes256-ctr,aes128-cbc,3des-cbc,3des-cbc,aes192-cbc,aes256-cbc",
+    "-o",
+    "GSSAPIAuthentication=no",
+    "-o",
+    "CheckHostIP=no"
+    )
+
+# SSH multiplexing options for the system transport, so that new connections to a host
+# reuse the already authenticated session instead of doing a full key exchange and login
+# (%C is a hash of the connection details, so long usernames or FQDNs can't make the
+# control socket path go over the unix socket path length limit)
+SSH_CONTROL_DIR = os.path.expanduser("~/.ssh")
+SSH_CONTROL_OPTIONS = (
+    "-o",
+    "ControlMaster=auto",
+    "-o",
+    f"ControlPath={os.path.join(SSH_CONTROL_DIR, 'netrun-%C')}",
+    "-o",
+    "ControlPersist=60s"
+    )
+
+# Encrypted credentials cache, reused between runs for CREDS_CACHE_TTL seconds
+# (requires the cryptography package and a passphrase in the NETRUN_KEY environment variable)
+CREDS_CACHE_FILE = os.path.expanduser("~/.cache/netrun/creds")
+CREDS_CACHE_TTL = 900
+CREDS_CACHE_SALT_SIZE = 16
+
+
+def int_at_least(minimum):
+    '''
+    Return an argparse type converting a value to an integer no lower than minimum.
 
+    '''
+    def convert(value):
+        try:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is None or number < minimum:
+            raise argparse.ArgumentTypeError(f"expected an integer >= {minimum}, got '{value}'")
+        return number
+    return convert
 
 
-def parse_arguments():
+def parse_arguments(argv=None):
     '''
-    Parse command line arguments.
+    Parse command line arguments (from sys.argv if argv is not given).
 
     '''
 
@@ -50,8 +128,8 @@ def parse_arguments():
     arg_group_hosts.add_argument(
         "-t",
         "--transport", 
-        metavar="<system|telnet|...>",
-        help="transport mechanism (default=system SSH)",
+        metavar="<ssh2|system|telnet|...>",
+        help="transport mechanism (default=ssh2, in-process libssh2)",
         default="ssh2"
         )
     arg_group_hosts.add_argument(
@@ -81,6 +159,16 @@ def parse_arguments():
         help="host port (default=22)",
         metavar="<port>"
         )
+    arg_group_hosts.add_argument(
+        "--resolve",
+        help="resolve hostnames once and connect by IP address (SSH config host entries won't match)",
+        action="store_true"
+        )
+    arg_group_hosts.add_argument(
+        "--ipv4-only",
+        help="only connect over IPv4 (system transport, or any transport with --resolve)",
+        action="store_true"
+        )
     
     # Command arguments
     arg_group_commands = parser.add_argument_group(
@@ -107,6 +195,11 @@ def parse_arguments():
         help="load commands from file netrun_deploy_<host>.txt for each host", 
         action="store_true"
         )
+    arg_group_commands.add_argument(
+        "--pipeline",
+        help="send commands without waiting for the prompt in between (only the output of the last command is kept)",
+        action="store_true"
+        )
 
     # Authentication credentials arguments
     arg_group_authentic = parser.add_argument_group(
@@ -134,6 +227,11 @@ def parse_arguments():
         help="do not go into enable mode after login",
         action="store_true"
         )
+    arg_group_authentic.add_argument(
+        "--no-cred-cache",
+        help="do not read or write the encrypted credentials cache",
+        action="store_true"
+        )
 
     # Output arguments
     arg_group_output = parser.add_argument_group(
@@ -162,6 +260,21 @@ def parse_arguments():
     arg_group_misc = parser.add_argument_group(
         title="Misc"
         )
+    arg_group_misc.add_argument(
+        "-w",
+        "--workers",
+        metavar="<n>",
+        help=f"number of hosts to connect to in parallel (default=NETRUN_CONCURRENCY or {DEFAULT_WORKERS})",
+        type=int_at_least(1)
+        )
+    arg_group_misc.add_argument(
+        "-r",
+        "--retries",
+        metavar="<n>",
+        help=f"number of times to retry connecting to a host on transient errors (default={DEFAULT_RETRIES})",
+        type=int_at_least(0),
+        default=DEFAULT_RETRIES
+        )
     arg_group_misc.add_argument(
         "--verbose", 
         help="display verbose debugging output", 
@@ -173,16 +286,363 @@ def parse_arguments():
         action="help"
         )
 
-    return parser.parse_args()
+    args = parser.parse_args(argv)
 
+    # The default number of workers can be set in the environment, it is checked here so that a
+    # bad value is reported like a bad command-line argument
+    if args.workers is None:
+        try:
+            args.workers = int_at_least(1)(os.environ.get("NETRUN_CONCURRENCY", DEFAULT_WORKERS))
+        except argparse.ArgumentTypeError as e:
+            parser.error(f"NETRUN_CONCURRENCY: {str(e)}")
+
+    return args
 
-def main():
+
+def _get_creds_cipher(salt):
+    '''
+    Return a Fernet cipher keyed from the NETRUN_KEY passphrase and the given salt, or None
+    if the credentials cache cannot be used.
+
+    '''
+    passphrase = os.environ.get("NETRUN_KEY")
+    if not passphrase:
+        return None
+    try:
+        from cryptography.fernet import Fernet
+        from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
+    except ImportError:
+        logging.info("[!] The cryptography package is not installed, credentials cache disabled")
+        return None
+    # The passphrase is stretched with scrypt, so that guessing it from a copy of the cache
+    # file is expensive
+    key = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1).derive(passphrase.encode())
+    return Fernet(base64.urlsafe_b64encode(key))
+
+
+def _load_cached_creds(ttl=CREDS_CACHE_TTL):
+    '''
+    Load the credentials saved by a previous run, if they are less than ttl seconds old.
+
+    '''
+    if not os.environ.get("NETRUN_KEY") or not os.path.exists(CREDS_CACHE_FILE):
+        return {}
+    try:
+        # The cache file holds the random key derivation salt followed by the Fernet token
+        with open(CREDS_CACHE_FILE, "rb") as f:
+            data = f.read()
+        cipher = _get_creds_cipher(data[:CREDS_CACHE_SALT_SIZE])
+        if not cipher:
+            return {}
+        creds = json.loads(cipher.decrypt(data[CREDS_CACHE_SALT_SIZE:], ttl=ttl))
+    except Exception:
+        # Expired token, wrong passphrase or corrupted file
+        logging.info("[!] Cached credentials are expired or invalid, ignoring them")
+        return {}
+    logging.info(f"[+] Loaded cached credentials from {CREDS_CACHE_FILE}")
+    return creds
+
+
+def _save_cached_creds(creds):
     '''
-    netrun.py Main program
+    Encrypt and save the credentials to the cache file (readable by the current user only).
+    Like loading, saving is best-effort and never fails the run.
+
+    '''
+    temp_file = f"{CREDS_CACHE_FILE}.{os.getpid()}.tmp"
+    try:
+        salt = os.urandom(CREDS_CACHE_SALT_SIZE)
+        cipher = _get_creds_cipher(salt)
+        if not cipher:
+            return
+        os.makedirs(os.path.dirname(CREDS_CACHE_FILE), mode=0o700, exist_ok=True)
+        # The credentials are written to a new file created with mode 600 and moved over the old
+        # one, so an existing cache file can't keep wider permissions
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            f.write(salt + cipher.encrypt(json.dumps(creds).encode()))
+        os.replace(temp_file, CREDS_CACHE_FILE)
+    except Exception as e:
+        # Unwritable cache directory, or scrypt not supported by the OpenSSL build
+        logging.info(f"[!] Could not save the credentials cache ({str(e)})")
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+
+class FailedHostsLog:
+    '''
+    Record the hosts that could not be connected to or failed to run the commands, and write
+    them to a text file in one go at the end of the run (the file is only created if at least
+    one host failed).
+
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.hosts = []
+        self.lock = threading.Lock()
+
+    def add(self, host):
+        with self.lock:
+            self.hosts.append(host)
+
+    def close(self):
+        with self.lock:
+            if self.hosts:
+                # A single write on an O_APPEND descriptor, so the lines can't interleave with
+                # another netrun run appending to the same file
+                flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_CLOEXEC", 0)
+                fd = os.open(self.filename, flags, 0o644)
+                try:
+                    os.write(fd, ("\n".join(self.hosts) + "\n").encode())
+                finally:
+                    os.close(fd)
+                self.hosts = []
+
+
+def iter_lines(filename):
+    '''
+    Yield the non-empty lines of a text file, without their trailing whitespace and newline.
+
+    '''
+    with open(filename, "r") as f:
+        for line in f:
+            line = line.rstrip()
+            if line:
+                yield line
+
+
+def load_lines(filename):
+    '''
+    Return the non-empty lines of a text file as a list (scrapli needs the full list of
+    commands to send them as a batch).
+
+    '''
+    return list(iter_lines(filename))
+
+
+def resolve_host(host, family=socket.AF_UNSPEC):
+    '''
+    Resolve a hostname to an IP address. Results are cached for DNS_CACHE_TTL seconds, so that
+    a name is only looked up once, while long runs still pick up DNS changes.
+
+    '''
+    now = time.monotonic()
+    cached = DNS_CACHE.get((host, family))
+    if cached and cached[1] > now:
+        return cached[0]
+    address = socket.getaddrinfo(host, None, family=family, type=socket.SOCK_STREAM)[0][4][0]
+    DNS_CACHE[(host, family)] = (address, now + DNS_CACHE_TTL)
+    return address
+
+
+def resolve_hosts(hosts, family, failed_hosts):
+    '''
+    Resolve all hosts in parallel (filling the DNS cache) and return the ones that resolved.
+    Unresolvable hosts are recorded as failed without attempting to connect to them.
+
+    '''
+    def try_resolve(host):
+        try:
+            return resolve_host(host, family)
+        except (OSError, UnicodeError) as e:
+            # Malformed names (like an empty label) fail IDNA encoding with a UnicodeError
+            logging.fatal(f"[!] Error: could not resolve {host} ({str(e)})")
+            return None
+
+    with ThreadPoolExecutor(max_workers=DNS_WORKERS) as executor:
+        addresses = list(executor.map(try_resolve, hosts))
+
+    resolved_hosts = []
+    for host, address in zip(hosts, addresses):
+        if address is None:
+            failed_hosts.add(host)
+        else:
+            resolved_hosts.append(host)
+    return resolved_hosts
+
+
+def build_save_dir(args, date_time, host=None):
+    '''
+    Build the output directory from the --output-directory template and create it if needed.
+
+    '''
+    logging.info(f"[+] Setting output directory")
+    if not args.output_directory:
+        return os.getcwd()
+    save_dir = args.output_directory.format(
+        date_time=date_time, 
+        host=host, 
+        username=args.username
+        )
+    os.makedirs(save_dir, exist_ok=True)
+    return save_dir
+
+
+def open_with_retry(conn, host, retries):
+    '''
+    Open the connection to a host, retrying with an exponential backoff on transient errors
+    (for example when the SSH server is rate-limiting new sessions).
+
+    '''
+    from scrapli.exceptions import ScrapliConnectionNotOpened, ScrapliTimeout
+
+    for attempt in range(retries + 1):
+        try:
+            conn.open()
+            return
+        except (ScrapliConnectionNotOpened, ScrapliTimeout) as e:
+            # Only connection-level errors are retried: authentication or privilege errors (like a
+            # wrong enable secret) would fail again the same way and only risk locking the account
+            if attempt == retries:
+                raise
+            # The same driver object is reused for the next attempt, so release what the failed
+            # attempt may have left open. The ssh2 and paramiko transports only close their socket
+            # along with an opened session, so it is closed explicitly after a failed handshake
+            conn.transport.close()
+            transport_socket = getattr(conn.transport, "socket", None)
+            if transport_socket is not None:
+                transport_socket.close()
+            delay = min(RETRY_MAX_DELAY, 2 ** attempt + random.random())
+            logging.warning(f"[!] Connection to {host} failed ({str(e)}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def run_host(host, args, commands, date_time, driver_class, conn_kwargs, failed_hosts, save_dir=None, deploy_files=None):
+    '''
+    Connect to a single host, run the commands and print or save the output. Returns True if
+    the host could be logged in to.
+
+    '''
+    from scrapli.exceptions import ScrapliException
+
+    # If we use deploy mode, we'll load the commands from a text file named netrun_deploy_<host>.txt
+    # before connecting, so that hosts without a deploy file are skipped without opening a session
+    if args.deploy:
+        filename = f"netrun_deploy_{host}.txt"
+        try:
+            if filename not in deploy_files:
+                raise FileNotFoundError(filename)
+            # The file may still have been removed since the directory was scanned
+            commands = load_lines(filename)
+        except FileNotFoundError:
+            logging.warning(f"[!] No netrun_deploy file found for {host}. Skipping to next one.")
+            return
+        logging.info(f"[+] Successfully loaded commands from {filename}")
+
+    # Scrapli can't send an empty batch of commands, and there is no point in connecting anyway
+    if not commands:
+        logging.warning(f"[!] No commands to run on {host}. Skipping to next one.")
+        return
+
+    logging.info(f"[+] Initializing network driver for {host}")
+    try:
+        # Connect by IP address if hostnames are resolved by netrun
+        address = host
+        if args.resolve:
+            address = resolve_host(host, socket.AF_INET if args.ipv4_only else socket.AF_UNSPEC)
+            logging.info(f"[+] Resolved {host} to {address}")
+
+        # Create Scrapli network driver object and open SSH channel
+        conn = driver_class(host=address, **conn_kwargs)
+        logging.warning(f"[+] Connecting to host {host}")
+        open_with_retry(conn, host, args.retries)
+    except Exception as e:
+        logging.fatal(f"[!] Error: {str(e)}")
+        failed_hosts.add(host)
+        return
+    logging.info(f"[+] Successfully connected and authenticated to {host}")
+
+    # Run all commands in a single batch over the open channel, and close the connection before
+    # handling the output so the session on the host is not held open during disk writes
+    try:
+        logging.info(f"[+] Sending commands to host {host}")
+        # In pipeline mode, scrapli's eager mode only waits for the prompt after the last command
+        responses = conn.send_commands(commands, eager=args.pipeline)
+    except ScrapliException as e:
+        # Only this host is given up on, the other workers keep running
+        logging.fatal(f"[!] Error: could not run the commands on {host} ({str(e)})")
+        failed_hosts.add(host)
+        return True
+    finally:
+        logging.info(f"[+] Closing connection to {host}")
+        conn.close()
+
+    # The output is built in memory and written in one go, which also keeps the output
+    # of hosts running in parallel from getting mixed up on the terminal
+    output = []
+
+    # If saving and separate outputs are not enabled, print separator header per host
+    if not args.save and not args.separate_output:
+        output.append(f"\n{STAR_SEPARATOR}\n")
+        output.append(f"***** {host} ".ljust(SEPARATOR_WIDTH, "*") + "\n")
+        output.append(f"{STAR_SEPARATOR}\n")
+
+    # If saving is enabled, build the output path and filename (the output directory is
+    # only resolved here when it depends on the host)
+    if args.save:
+        if save_dir is None:
+            save_dir = build_save_dir(args, date_time, host)
+        filename = os.path.join(save_dir, f"netrun_output_{host}_{date_time}.txt")
+        logging.info(f"[+] Output will be saved to {filename}")
+
+    for response in responses:
+        # In pipeline mode, scrapli doesn't read the output of the commands sent before the last
+        # one, so their empty responses are skipped instead of being shown as empty outputs
+        if args.pipeline and response is not responses[-1] and not response.result:
+            continue
+
+        # Each response carries the command it was sent for
+        c = response.channel_input
+
+        # Timestamps are per command on purpose: they record when each command was sent,
+        # as measured by scrapli, so no clock lookup is needed here
+        now = response.start_time.strftime(TIMESTAMP_FORMAT)
+
+        # Separator header per command, followed by the command output (kept as a separate
+        # chunk so that large outputs like "show tech-support" are never copied around)
+        command_output = [
+            f"{DASH_SEPARATOR}\n"
+            f"[{now}] {host}: Output of command \'{c}\':\n"
+            f"{DASH_SEPARATOR}\n",
+            response.result,
+            "\n\n"
+            ]
+
+        if args.save and args.separate_output:
+            # Whitespaces and unsafe characters in the command will be replaced by dashes in the filename
+            command_filename = os.path.join(
+                save_dir, 
+                f"{host}_{c.translate(FILENAME_TRANSLATION)}_{now}.txt"
+                )
+            logging.warning(f"[+] Saving output of '{c}' to {command_filename}")
+            with open(command_filename, "w", buffering=OUTPUT_BUFFER_SIZE, encoding="utf-8") as f:
+                f.writelines(command_output)
+        else:
+            if args.save:
+                logging.warning(f"[+] Saving output of '{c}' to {filename}")
+            output.extend(command_output)
+
+    # Print or save the collected output in one go
+    if not args.save:
+        with PRINT_LOCK:
+            sys.stdout.writelines(output)
+            sys.stdout.flush()
+    elif not args.separate_output:
+        with open(filename, "w", buffering=OUTPUT_BUFFER_SIZE, encoding="utf-8") as f:
+            f.writelines(output)
+
+    return True
+
+
+def main(argv=None):
+    '''
+    netrun.py Main program, can also be called from Python with a list of arguments
 
     '''
     # Parse command line arguments
-    args = parse_arguments()
+    args = parse_arguments(argv)
 
     # Initialize logging
     if args.verbose:
@@ -193,41 +653,72 @@ def main():
     # Get list of hosts from file or CLI
     logging.info("[+] Parsing host list")
     if args.inventory_file:
-        with open(args.inventory_file) as f:
-            list_of_hosts = f.readlines()
+        inventory = ( line.strip() for line in iter_lines(args.inventory_file) )
     else:
-        list_of_hosts = args.inventory.split(",")
+        inventory = ( host.strip() for host in args.inventory.split(",") )
+
+    # Remove empty lines, comments and duplicate hosts while keeping the inventory order, so each
+    # host is only connected to once (and does not overwrite its own output files)
+    seen_hosts = set()
+    list_of_hosts = []
+    for host in inventory:
+        if not host or host.startswith(("#", "!")):
+            continue
+        if host in seen_hosts:
+            logging.warning(f"[!] Host {host} is listed more than once, its commands will only run once")
+            continue
+        seen_hosts.add(host)
+        list_of_hosts.append(host)
     logging.info(f"[+] Found hosts: {','.join(list_of_hosts)}")
 
     # Get commands from text file or arguments
     if args.commands_file:
-        with open(args.commands_file, "r") as f:
-            commands = [ line.rstrip() for line in f.readlines() if line.strip() ]
+        commands = load_lines(args.commands_file)
     elif args.deploy:
-        # In case of deploy mode we will load the commands further up
-        pass
+        # In case of deploy mode the commands are loaded per host in run_host()
+        commands = None
     else:
-        # Build commands from the command-line arguments
-        commands = " ".join(args.commands).split(",")
+        # Build commands from the command-line arguments (the words of unquoted commands come
+        # as separate arguments, hence the join before splitting on commas)
+        commands = [ c.strip() for c in " ".join(args.commands).split(",") if c.strip() ]
 
-    # Used to redirect stdout to screen if not saving to file
-    output_file_object = None
+    # Credentials cached by a previous run are used before prompting
+    cached_creds = {}
+    if not args.no_cred_cache:
+        cached_creds = _load_cached_creds()
+    saved_creds = dict(cached_creds)
 
     # If no username is specified, we will prompt at runtime
     if not args.username:
         if os.environ.get("NETRUN_USERNAME"):
             args.username = os.environ.get("NETRUN_USERNAME")
+        elif cached_creds.get("username"):
+            args.username = cached_creds["username"]
         else:
             args.username = input("SSH Username: ")
 
+    # Cached passwords are only valid for the username they were cached with
+    if cached_creds.get("username") != args.username:
+        cached_creds = {}
+
     # If no password is specified, we will prompt at runtime
+    password_from_cache = False
     if not args.password:
         if os.environ.get("NETRUN_PASSWORD"):
             args.password = os.environ.get("NETRUN_PASSWORD")
+        elif cached_creds.get("password"):
+            args.password = cached_creds["password"]
+            password_from_cache = True
         else:
+            import getpass
             args.password = getpass.getpass("SSH Password: ")
 
+    # A cached enable secret is only used along with the cached password it was saved with
+    if not password_from_cache:
+        cached_creds.pop("enable_password", None)
+
     # Define privilege level (exec or enable mode) to use after login
+    enable_from_password = False
     if args.no_enable:
         privilege_level = "exec"
     else:
@@ -236,9 +727,24 @@ def main():
         if not args.enable_password:
             if os.environ.get("NETRUN_ENABLE"):
                 args.enable_password = os.environ.get("NETRUN_ENABLE")
+            elif cached_creds.get("enable_password"):
+                args.enable_password = cached_creds["enable_password"]
             else:
                 logging.info(f"[+] No enable secret has been specified, using the user password")
                 args.enable_password = args.password
+                enable_from_password = True
+
+    # Credentials to save for the next runs, if they differ from the cached ones (an enable
+    # secret defaulting to the password is not saved, so that it keeps following the password)
+    creds_to_cache = None
+    if not args.no_cred_cache:
+        creds = {
+            "username": args.username,
+            "password": args.password,
+            "enable_password": None if enable_from_password else args.enable_password
+            }
+        if creds != saved_creds:
+            creds_to_cache = creds
 
     # Define SSH/Telnet default TCP port
     if not args.port:
@@ -247,108 +753,117 @@ def main():
         else:
             args.port = 22
 
+    # The SSH control sockets of the system transport are created in ~/.ssh
+    if args.transport == "system":
+        os.makedirs(SSH_CONTROL_DIR, mode=0o700, exist_ok=True)
+
     # Registering date/time for use in filenames
-    date_time = datetime.strftime(datetime.now(), "%Y-%m-%d_%Hh%Mm%S")
+    date_time = time.strftime(TIMESTAMP_FORMAT, time.localtime())
+
+    # Scrapli is only imported once the arguments are parsed, so that --help and argument
+    # errors don't pay for loading it and its transport libraries
+    from scrapli import Scrapli
+    from scrapli.exceptions import ScrapliException
+    from scrapli.transport import ASYNCIO_TRANSPORTS
+
+    # The Scrapli factory is bypassed below, so its check rejecting the asyncio transports
+    # (only usable with AsyncScrapli) is done here, once for the whole run
+    if args.transport in ASYNCIO_TRANSPORTS:
+        logging.fatal(f"[!] Error: {args.transport} is an asyncio transport, not supported by netrun")
+        sys.exit(1)
 
-    # Connect to each host, run the commands and print the output
-    for host in list_of_hosts:
-        host = host.strip()
-        logging.info(f"[+] Initializing network driver for {host}")
-        try:
-            # Create Scrapli network driver object and open SSH channel
-            conn = Scrapli(
-                host = host,
-                port = int(args.port), 
-                auth_username = args.username, 
-                auth_password = args.password, 
-                auth_secondary = args.enable_password,
-                auth_strict_key = False,
-                ssh_config_file = True,
-                default_desired_privilege_level = privilege_level,
-                transport = args.transport,
-                platform = args.platform,
-                timeout_socket = 15,
-                timeout_transport = 15,
-                transport_options = {"open_cmd": [
-                    "-o", 
-                    "KexAlgorithms=+diffie-hellman-group1-sha1,diffie-hellman-group-exchange-sha1,diffie-hellman-group14-sha1",
-                    "-o",
-                    "Ciphers=+aes128-ctr,aes192-ctr,aes256-ctr,aes128-cbc,3des-cbc,3des-cbc,aes192-cbc,aes256-cbc"
-                    ]}
-                )
-            logging.warning(f"[+] Connecting to host {host}")
-            conn.open()
-        except Exception as e:
-            logging.fatal(f"[!] Error: {str(e)}")
-            with open(f"netrun_failed_{date_time}.txt", "a") as f:
-                f.write(host + "\n")
-            continue
-        logging.info(f"[+] Successfully connected and authenticated to {host}")
-
-        # If we use deploy mode, we'll load the commands from a text file named <host>_netrun_deploy.txt
-        if args.deploy:
-            filename = f"netrun_deploy_{host}.txt"
-            if os.path.exists(filename):
-                with open(filename, "r") as f:
-                    commands = [ line.rstrip() for line in f.readlines() if line.strip() ]
-                    logging.info(f"[+] Successfully loaded commands from {filename}")
-            else:
-                logging.warn("[!] No netrun_deploy file found for this host. Skipping to next one.")
-                continue
-
-        # If saving and separate outputs are not enabled, print separator header per host
-        if not args.save and not args.separate_output:
-            print(file=output_file_object)
-            print(f"*****".ljust(SEPARATOR_WIDTH, "*"), file=output_file_object)
-            print(f"***** {host} ".ljust(SEPARATOR_WIDTH, "*"), file=output_file_object)
-            print(f"*****".ljust(SEPARATOR_WIDTH, "*"), file=output_file_object)        
-
-        # If saving is enabled, build the output path and filename
-        if args.save:
-            logging.info(f"[+] Setting output directory")
-            if args.output_directory:
-                save_dir = args.output_directory.format(
-                    date_time=date_time, 
-                    host=host, 
-                    username=args.username
-                    )
-                if not os.path.exists(save_dir):
-                    os.makedirs(save_dir, exist_ok=True)
-            else:
-                save_dir = os.getcwd()
-            filename = os.path.join(save_dir, f"netrun_output_{host}_{date_time}.txt")
-            if not args.separate_output:
-                output_file_object = open(filename, "w")
-            logging.info(f"[+] Output will be saved to {filename}")
-
-        # Run all commands sequentially
-        logging.info(f"[+] Sending commands to host")
-        for c in commands:
-            now = datetime.strftime(datetime.now(), "%Y-%m-%d_%Hh%Mm%S")
-            response = conn.send_command(c)
-            if args.save and args.separate_output:
-                # Whitespaces in the command will be replaced by dashes in the filename
-                filename = os.path.join(
-                    save_dir, 
-                    f"{host}_{c.replace(' ', '-')}_{now}.txt"
-                    )
-                output_file_object = open(filename, "w")
+    # Resolve the scrapli driver class of the platform once, instead of going through the
+    # Scrapli factory and its platform lookup for every host
+    try:
+        driver_class, driver_kwargs = Scrapli._get_driver(platform=args.platform, variant=None)
+    except ScrapliException as e:
+        logging.fatal(f"[!] Error: {str(e)}")
+        sys.exit(1)
 
-            if args.save:
-                logging.warning(f"[+] Saving output of '{c}' to {filename}")
+    # Build the extra options passed to the SSH client, only the system transport runs the
+    # ssh binary (the in-process ssh2 transport negotiates its algorithms through libssh2)
+    transport_options = {}
+    if args.transport == "system":
+        open_cmd = list(SSH_OPEN_CMD)
+        if args.ipv4_only:
+            open_cmd.append("-4")
+        open_cmd.extend(SSH_CONTROL_OPTIONS)
+        transport_options["open_cmd"] = open_cmd
+
+    # Build the driver arguments shared by all hosts once (arguments given here take precedence
+    # over the ones coming from community platform definitions)
+    conn_kwargs = dict(driver_kwargs)
+    conn_kwargs.update(
+        port = int(args.port), 
+        auth_username = args.username, 
+        auth_password = args.password, 
+        auth_secondary = args.enable_password,
+        auth_strict_key = False,
+        ssh_config_file = True,
+        default_desired_privilege_level = privilege_level,
+        transport = args.transport,
+        timeout_socket = 15,
+        timeout_transport = 15,
+        transport_options = transport_options
+        )
 
-            # Print separator header per command
-            print(f"-----".ljust(SEPARATOR_WIDTH, "-"), file=output_file_object)
-            print(f"[{now}] {host}: Output of command \'{c}\':", file=output_file_object)
-            print(f"-----".ljust(SEPARATOR_WIDTH, "-"), file=output_file_object)
-            print(f"{response.result}", file=output_file_object)
-            print(file=output_file_object)
-
-        # Close the output file handler and close the connection
-        if output_file_object:
-            output_file_object.close()
-        logging.info(f"[+] Closing connection")
-        conn.close()
+    # In deploy mode, list the available netrun_deploy files with a single directory scan
+    # instead of checking for the file of each host separately
+    deploy_files = set()
+    if args.deploy:
+        deploy_files = {
+            entry.name for entry in os.scandir(".")
+            if entry.name.startswith("netrun_deploy_") and entry.is_file()
+            }
+
+    # When saving, resolve and create the output directory once, unless it depends on the host
+    save_dir = None
+    if args.save and "{host" not in (args.output_directory or ""):
+        save_dir = build_save_dir(args, date_time)
+
+    # Hosts that could not be connected to or failed to run the commands are written to
+    # netrun_failed_<date_time>.txt
+    failed_hosts = FailedHostsLog(f"netrun_failed_{date_time}.txt")
+
+    try:
+        # With --resolve, look up all hosts in parallel before connecting, so that unresolvable
+        # hosts fail right away instead of each taking a worker slot
+        if args.resolve:
+            logging.info("[+] Resolving hosts")
+            list_of_hosts = resolve_hosts(
+                list_of_hosts,
+                socket.AF_INET if args.ipv4_only else socket.AF_UNSPEC,
+                failed_hosts
+                )
+
+        # Connect to the hosts in parallel, run the commands and print the output
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            futures = [
+                executor.submit(
+                    run_host, host, args, commands, date_time,
+                    driver_class, conn_kwargs, failed_hosts, save_dir, deploy_files
+                    )
+                for host in list_of_hosts
+                ]
+            # Re-raise any unexpected exception from the worker threads
+            logged_in = False
+            try:
+                for future in futures:
+                    if future.result():
+                        logged_in = True
+            except KeyboardInterrupt:
+                # Cancel the hosts that have not started yet, so that leaving the executor only
+                # waits for the connections already in progress
+                for future in futures:
+                    future.cancel()
+                raise
+
+        # Credentials are only saved once they have been used to log in, so that a mistyped
+        # password is not reused by the next runs
+        if creds_to_cache and logged_in:
+            _save_cached_creds(creds_to_cache)
+    finally:
+        failed_hosts.close()
 
     sys.exit(0)
 